@@ -6,30 +6,31 @@
 # Description: This file contains the main logic for the bot.
 # This bot helps students from the Open University to calculate their accurate GPA.
 
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove
-from telegram.ext import (Application, CommandHandler, MessageHandler,
+from telegram import Update, ReplyKeyboardRemove
+from telegram.ext import (Application, CommandHandler, MessageHandler, TypeHandler, ApplicationHandlerStop,
                           CallbackQueryHandler, filters, ConversationHandler, CallbackContext)
 import time
+import asyncio
 from utils import *
 from db import *
+from grade_list import GradeList
 
 
 async def start(update: Update, context: CallbackContext) -> int:
     """Starts the conversation with the user."""
     user_id = update.message.chat_id  # gets the user's id
     # gets if the user studies an exact sciences degree, returns -1 if the user has not chosen yet
-    exact_science_indication = await get_exact_science(user_id)
+    exact_science_indication, is_blocked = await get_exact_science_and_blocked(user_id)
+    if is_blocked:  # the user is reachable again if he was skipped by bulk sends, the others cost no write
+        await unblock_user(user_id)
     # if the user restarted the bot before picking a degree type for the first time
     if user_id in ACTIVE_USERS and exact_science_indication == -1:
         log_user(user_id, "restarted the bot before picking a degree type for the first time.")
         await update.message.reply_text(EXACT_SCIENCES_QUESTION, reply_markup=degree_yes_or_no_buttons())
         return ASK_DEGREE
 
-    keyboard_change_degree = [[  # creates inline buttons for the user to choose if he studies an exact sciences degree
-        InlineKeyboardButton("החלף סוג תואר", callback_data="change_degree"),
-    ]]
-
-    reply_markup_change_degree = InlineKeyboardMarkup(keyboard_change_degree)
+    # inline button for the user to change his degree type
+    reply_markup_change_degree = REPLY_MARKUPS["change_degree"]
 
     if exact_science_indication != -1:  # if the user has already chosen if he studies an exact sciences degree
         if user_id in ACTIVE_USERS:  # if the user restarted the bot before finishing
@@ -39,7 +40,7 @@ async def start(update: Update, context: CallbackContext) -> int:
             ACTIVE_USERS[user_id] = time.time() # adds the user to the active users dictionary
             log_user_and_active_users(user_id, "restarted the bot")
             context.user_data["user_id"] = user_id  # stores the user's id in the context
-        context.user_data["grades"] = []
+        context.user_data["grades"] = GradeList()
         if exact_science_indication == 1:  # if the user studies an exact sciences degree
             await update.message.reply_text(EXACT_ACKNOWLEDGEMENT, reply_markup=reply_markup_change_degree)
         else:
@@ -64,7 +65,7 @@ async def ask_degree(update: Update, context: CallbackContext) -> int:
     is_exact_science = (query.data == "degree_yes") # either True or False
     log_user(context.user_data["user_id"], "successfully chose his degree type")
     await update_exact_science(context.user_data["user_id"], is_exact_science)  # updates the user's choice in the database
-    context.user_data["grades"] = []  # creates an empty list to store the user's grades
+    context.user_data["grades"] = GradeList()  # creates an empty list to store the user's grades
 
     await query.message.reply_text(GRADE_PROMPT, reply_markup=load_grades_buttons()) # prompts the user to enter his grades
     return ENTER_GRADE
@@ -88,13 +89,14 @@ async def receive_grade(update: Update, context: CallbackContext) -> int:
                 await query.message.reply_text(NO_GRADES_ENTERED_DELETE_PRESSED)
                 log_user(context.user_data["user_id"], "tried to delete grades without entering any")
                 return ENTER_GRADE
-            keyboard = [[
-                InlineKeyboardButton("חזור להזנת ציונים", callback_data="go_back"),
-            ]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.message.reply_text(DELETE_GRADE_PROMPT, reply_markup=reply_markup)
+            await query.message.reply_text(DELETE_GRADE_PROMPT, reply_markup=REPLY_MARKUPS["go_back"])
             await query.answer(WAITING_FOR_INDICES)
             return DELETE_GRADE
+        elif query.data == "plan": # if the user wants to know what he needs to reach a target average
+            log_user(context.user_data["user_id"], "started planning a target average")
+            await query.message.reply_text(PLAN_PROMPT, reply_markup=REPLY_MARKUPS["go_back"])
+            await query.answer(WAITING_FOR_PLAN)
+            return PLAN_GRADES
         elif query.data == "change_degree": # if the user wants to change his degree type
             log_user(context.user_data["user_id"], "decided to change his degree type")
             await query.message.reply_text(EXACT_SCIENCES_QUESTION, reply_markup=degree_yes_or_no_buttons())
@@ -144,20 +146,12 @@ async def receive_grade(update: Update, context: CallbackContext) -> int:
 async def choose_course_type(update: Update, context: CallbackContext) -> int:
     """Asks the user if the course is advanced or regular using inline buttons - exact sciences student."""
 
-    advanced = "מתקדם"
-    regular = "רגיל"
     msg = COURSE_TYPE_QUESTION_SHORT
+    reply_markup = REPLY_MARKUPS["course_type_short"] # inline buttons for the user to choose the course type
     if len(context.user_data["curr_grades"]) > 1: # if the user entered more than one grade
-        advanced = "מתקדמים"
-        regular = "רגילים"
         msg = COURSE_TYPE_QUESTION_LONG
+        reply_markup = REPLY_MARKUPS["course_type_long"]
 
-    # creates inline buttons for the user to choose the course type
-    keyboard = [[  # creates inline buttons for the user to choose the course type
-        InlineKeyboardButton(advanced, callback_data="advanced"),
-        InlineKeyboardButton(regular, callback_data="regular")
-    ]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text(msg, reply_markup=reply_markup)
 
     return CHOOSE_COURSE_TYPE
@@ -227,6 +221,52 @@ async def delete_grade(update: Update, context: CallbackContext) -> int:
         return DELETE_GRADE
 
 
+async def plan_grades(update: Update, context: CallbackContext) -> int:
+    """Tells the user the minimum grade he needs in his planned courses to reach a target average."""
+    if update.callback_query:  # if the user clicked an inline button
+        query = update.callback_query
+        if query.data == "go_back":
+            log_user(context.user_data["user_id"], "decided to go back to entering grades")
+            await query.answer(GOING_BACK_TO_GRADES_INPUT)
+            if context.user_data["grades"]:
+                grades_typed = get_history(context)
+                await query.message.reply_text(ADD_GRADE + grades_typed, reply_markup=add_grades_buttons())
+            else:
+                await query.message.reply_text(GRADE_PROMPT, reply_markup=load_grades_buttons())
+            return ENTER_GRADE
+
+    text = update.message.text.strip()  # gets the user's target and planned courses
+    try:
+        target, planned = get_plan_input(text)
+    except ValueError:  # if the user's input is not in the correct format
+        await update.message.reply_text(PLAN_FORMAT_ERROR)
+        log_user(context.user_data["user_id"], "entered a plan in the wrong format")
+        return PLAN_GRADES
+    if not check_plan_input(target, planned):
+        await update.message.reply_text(PLAN_RANGE_ERROR)
+        log_user(context.user_data["user_id"], "entered a plan out of range")
+        return PLAN_GRADES
+
+    is_exact = await get_exact_science(context.user_data["user_id"])
+    # all the possible grades are evaluated in memory, nothing is written to the database
+    grade, average = plan_required_grade(context.user_data["grades"], planned, target, is_exact == 1)
+    if grade is None:  # if the target can not be reached even with the maximum grade
+        msg = PLAN_UNREACHABLE.format(grade=MAX_GRADE, average=average, target=target)
+    elif grade == MIN_GRADE:  # if the target is reached even with the minimum grade
+        msg = PLAN_ALREADY_REACHED.format(grade=MIN_GRADE, average=average, target=target)
+    else:
+        msg = PLAN_REQUIRED_GRADE.format(grade=grade, average=average, target=target)
+    await update.message.reply_text(msg)
+    log_user(context.user_data["user_id"], "planned a target average successfully")
+
+    if context.user_data["grades"]:
+        grades_typed = get_history(context)
+        await update.message.reply_text(ADD_GRADE + grades_typed, reply_markup=add_grades_buttons())
+    else:
+        await update.message.reply_text(GRADE_PROMPT, reply_markup=load_grades_buttons())
+    return ENTER_GRADE
+
+
 async def calculate_average(update: Update, context: CallbackContext) -> int:
     """Calculates the weighted average of the user's grades."""
     query = update.callback_query
@@ -236,10 +276,8 @@ async def calculate_average(update: Update, context: CallbackContext) -> int:
     grades = context.user_data["grades"]  # gets the user's grades
     is_exact = await get_exact_science(user_id)  # gets if the user studies an exact sciences degree
 
-    # calculates the total weighted grades
-    total_weighted = sum(grade * credits * (ADVANCED_COURSE if is_exact and is_advanced else 1) for _, grade, credits, is_advanced in grades)
-    # calculates the total credits
-    total_credits = sum(credits * (ADVANCED_COURSE if is_exact and is_advanced else 1) for _, _, credits, is_advanced in grades)
+    # calculates the total weighted grades and the total credits
+    total_weighted, total_credits = get_weighted_totals(grades, is_exact == 1)
     weighted_avg = total_weighted / total_credits  # calculates the weighted average
 
     await query.message.reply_text(f"🎓 הממוצע המשוקלל שלך הוא: {weighted_avg:.2f}", reply_markup=ReplyKeyboardRemove())
@@ -252,11 +290,7 @@ async def calculate_average(update: Update, context: CallbackContext) -> int:
         return await end(query, context)
 
     # asks the user if he wants to save his current grades
-    keyboard = [[
-        InlineKeyboardButton("אין צורך", callback_data="dont_save_grades"),
-        InlineKeyboardButton("כן", callback_data="save_grades"),
-    ]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = REPLY_MARKUPS["save_grades"]
     if not saved_grades:  # if the user does not have saved grades
         await query.message.reply_text(NOT_EXISTS_SAVED_GRADES_PROMPT, reply_markup=reply_markup)
     else:
@@ -359,7 +393,7 @@ async def single_message_handler(update: Update, context: CallbackContext) -> No
     target_user_id = context.user_data["target_user_id"]  # gets the target user's id
     private_message = update.message.text.strip()  # gets the admin's private message
     log_user(user_id, f"wrote a private message to user {target_user_id}: {private_message}")
-    await send_single_message(target_user_id, private_message)  # sends the private message to the user
+    await send_single_message(context.bot, target_user_id, private_message)  # sends the private message to the user
     await update.message.reply_text(SINGLE_ACKNOWLEDGEMENT)
 
 async def broadcast_handler(update: Update, context: CallbackContext) -> None:
@@ -367,18 +401,52 @@ async def broadcast_handler(update: Update, context: CallbackContext) -> None:
     user_id = update.message.chat_id
     broadcast_message = update.message.text.strip()  # gets the admin broadcast message
     log_user(user_id, f"wrote the broadcast message: {broadcast_message}")
-    successfully_sent = await send_broadcast_message(broadcast_message)  # sends the broadcast message to all users
-    await update.message.reply_text(f"✅ ההודעה נשלחה בהצלחה ל-{successfully_sent} משתמשים.")
+    job_id, _ = await create_broadcast_job(broadcast_message, user_id)  # persists the broadcast as a job
+    progress_message = await update.message.reply_text(get_broadcast_job_text(await get_broadcast_job(job_id)))
+    await set_broadcast_progress_message(job_id, progress_message.message_id)
+    start_broadcast_job(context.application, job_id)  # sends the broadcast message to all users in the background
+
+async def broadcast_status_handler(update: Update, context: CallbackContext) -> None:
+    """Handles the admin's request to see the status of a broadcast job (the last one by default)."""
+    user_id = update.message.chat_id
+    try:
+        job_id = int(context.args[0]) if context.args else await get_last_broadcast_job_id()
+    except ValueError:
+        await update.message.reply_text(BROADCAST_JOB_ID_ERROR)
+        return
+    job = await get_broadcast_job(job_id)
+    if job is None:
+        await update.message.reply_text(BROADCAST_JOB_NOT_FOUND)
+        return
+    job_id, _, status, _, _, total, sent, failed, skipped = job
+    log_user(user_id, f"checked the status of broadcast job {job_id}")
+    await update.message.reply_text(BROADCAST_JOB_STATUS.format(
+        job_id=job_id, status=BROADCAST_STATUS_NAMES[status], sent=sent, total=total, failed=failed, skipped=skipped))
+    await update.message.reply_text(BLOCKED_USERS_REPORT.format(blocked=await get_total_blocked_users()))
+
+async def cancel_broadcast_handler(update: Update, context: CallbackContext) -> None:
+    """Handles the admin's request to cancel a running broadcast job."""
+    user_id = update.message.chat_id
+    try:
+        job_id = int(context.args[0])
+    except (IndexError, ValueError):
+        await update.message.reply_text(BROADCAST_JOB_ID_ERROR)
+        return
+    if await get_broadcast_job(job_id) is None:
+        await update.message.reply_text(BROADCAST_JOB_NOT_FOUND)
+        return
+    # the worker stops at its next checkpoint when it sees the new status
+    if not await update_broadcast_job_status(job_id, "cancelled"):
+        await update.message.reply_text(BROADCAST_JOB_NOT_RUNNING.format(job_id=job_id))
+        return
+    log_user(user_id, f"cancelled broadcast job {job_id}")
+    await update.message.reply_text(BROADCAST_JOB_CANCEL_REQUESTED.format(job_id=job_id))
 
 async def start_feedback_process(update: Update, context: CallbackContext) -> int:
     """Handles the user's request to write feedback."""
     user_id = update.message.chat_id
     log_user(user_id, "started writing a feedback")
-    keyboard = [[
-        InlineKeyboardButton("אני לא מעוניין לכתוב פידבק", callback_data="exit_feedback"),
-    ]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text(FEEDBACK_MSG, reply_markup=reply_markup)
+    await update.message.reply_text(FEEDBACK_MSG, reply_markup=REPLY_MARKUPS["exit_feedback"])
     return WRITE_FEEDBACK
 
 async def feedback_handler(update: Update, context: CallbackContext) -> int:
@@ -394,20 +462,117 @@ async def feedback_handler(update: Update, context: CallbackContext) -> int:
         feedback = update.message.text.strip()  # gets the user's feedback
         log_user(user_id, f"wrote a feedback")
         feedback_logger.info(f"User {user_id} wrote the feedback: {feedback}")
+        FEEDBACK_QUEUE.put_nowait((user_id, feedback, int(time.time())))  # saved to the database in the background
         await update.message.reply_text(FEEDBACK_ACKNOWLEDGEMENT)
     return await end(update, context)  # ends the conversation
 
-def main():
-    """Main function to run the bot."""
-    app = Application.builder().token(TOKEN).build()
-    setup_database() # creates the database if it does not exist
+async def feedbacks_handler(update: Update, context: CallbackContext) -> None:
+    """Handles the admin's request to search and page through the feedbacks."""
+    user_id = update.message.chat_id
+    try:
+        keyword, start_time, end_time, page = get_feedback_query(context.args)
+    except ValueError:
+        await update.message.reply_text(FEEDBACK_QUERY_ERROR)
+        return
+    count = await count_feedbacks(keyword, start_time, end_time)
+    feedbacks = await search_feedbacks(keyword, start_time, end_time, FEEDBACK_PAGE_SIZE,
+                                       (page - 1) * FEEDBACK_PAGE_SIZE)
+    log_user(user_id, "searched the feedbacks")
+    if not feedbacks:
+        await update.message.reply_text(NO_FEEDBACKS_FOUND)
+        return
+    await update.message.reply_text(get_feedbacks_page(feedbacks, count, page))
+
+async def feedback_count_handler(update: Update, context: CallbackContext) -> None:
+    """Handles the admin's request to count the feedbacks."""
+    user_id = update.message.chat_id
+    try:
+        keyword, start_time, end_time, _ = get_feedback_query(context.args)
+    except ValueError:
+        await update.message.reply_text(FEEDBACK_QUERY_ERROR)
+        return
+    count = await count_feedbacks(keyword, start_time, end_time)
+    log_user(user_id, "counted the feedbacks")
+    await update.message.reply_text(FEEDBACKS_COUNT.format(count=count))
+
+async def admission_control_handler(update: Update, context: CallbackContext) -> None:
+    """Sheds the updates of users that flood the bot and all the updates when the bot is overloaded."""
+    now = time.time()
+    LAST_ACTIVITY["time"] = now  # the database maintenance waits for the bot to be idle
+    user = update.effective_user
+    if user is None or user.id == get_admin_id():  # the admin is never slowed down
+        return
+    text = update.message.text if update.message else None
+    if context.application.update_queue.qsize() >= MAX_PENDING_UPDATES:  # if too many updates are waiting
+        SHED_COUNTERS["overloaded"] += 1
+    elif not admit_update(user.id, get_update_cost(text), now):
+        SHED_COUNTERS["rate_limited"] += 1
+    elif text and text.count("\n") >= MAX_INPUT_LINES:  # the paste was paid for, so these replies are limited too
+        SHED_COUNTERS["too_long"] += 1
+        await update.message.reply_text(INPUT_TOO_LONG)
+        raise ApplicationHandlerStop
+    else:
+        return
+
+    # a flood costs at most one slow down reply per user in a while, and the reply is sent in the background,
+    # so shedding an update does not wait for telegram
+    if should_reply_slow_down(user.id, now):
+        if update.callback_query:  # answering the button also stops its loading animation
+            context.application.create_task(update.callback_query.answer(SLOW_DOWN), update=update)
+        elif update.message:
+            context.application.create_task(update.message.reply_text(SLOW_DOWN), update=update)
+    raise ApplicationHandlerStop  # the update does not reach the conversation
+
+async def admission_stats_handler(update: Update, context: CallbackContext) -> None:
+    """Handles the admin's request to see how many updates were shed."""
+    log_user(update.message.chat_id, "checked the admission control stats")
+    await update.message.reply_text(ADMISSION_STATS.format(tracked=len(RATE_LIMIT_BUCKETS), **SHED_COUNTERS))
+
+async def post_init(application: Application) -> None:
+    """Starts the bot's background work once the bot is initialized."""
+    # in a sharded deployment only the coordinator runs the work that is shared by all the users
+    if application.bot_data["is_coordinator"]:
+        await asyncio.to_thread(setup_database)  # creates the database if it does not exist
+        await resume_broadcast_jobs(application)  # resumes the interrupted broadcast jobs
+        start_database_maintenance(application.bot_data["last_activity"])
+    start_feedback_writer()
+
+async def post_stop(application: Application) -> None:
+    """Stops the broadcast jobs while the bot can still send, they resume from their checkpoints on the next start."""
+    await stop_broadcast_jobs()
+
+async def post_shutdown(application: Application) -> None:
+    """Finishes the bot's background work before the bot exits."""
+    await stop_database_maintenance()
+    await stop_feedback_writer()
+
+def build_application(is_coordinator: bool = True, with_updater: bool = True,
+                      last_activity=get_last_activity) -> Application:
+    """
+    Creates the bot's application with all its handlers.
+    A sharded deployment's worker has no updater, the dispatcher passes the updates to it,
+    and last_activity returns the time the dispatcher received its last update.
+    """
+    builder = (Application.builder().token(get_token()).base_url(get_bot_api_url())
+               .post_init(post_init).post_stop(post_stop).post_shutdown(post_shutdown))
+    if not with_updater:
+        builder = builder.updater(None)
+    app = builder.build()
+    app.bot_data["is_coordinator"] = is_coordinator
+    app.bot_data["last_activity"] = last_activity
+    admin_filter = filters.User(user_id=get_admin_id())
 
     # creates a conversation handler
     common_commands_and_unknown_command_handling = [
         CommandHandler("start", start),
         CommandHandler("feedback", start_feedback_process),
-        CommandHandler("broadcast", start_broadcast_process, filters=filters.User(user_id=ADMIN_ID)),
-        CommandHandler("single", start_single_process, filters=filters.User(user_id=ADMIN_ID)),
+        CommandHandler("broadcast", start_broadcast_process, filters=admin_filter),
+        CommandHandler("single", start_single_process, filters=admin_filter),
+        CommandHandler("broadcast_status", broadcast_status_handler, filters=admin_filter),
+        CommandHandler("cancel_broadcast", cancel_broadcast_handler, filters=admin_filter),
+        CommandHandler("feedbacks", feedbacks_handler, filters=admin_filter),
+        CommandHandler("feedback_count", feedback_count_handler, filters=admin_filter),
+        CommandHandler("admission_stats", admission_stats_handler, filters=admin_filter),
         MessageHandler(filters.COMMAND, unknown_command_handler),
     ]
     conv_handler = ConversationHandler(
@@ -427,6 +592,11 @@ def main():
                 CallbackQueryHandler(receive_grade, pattern="^change_degree$"),
                 CallbackQueryHandler(receive_grade, pattern="^load_last_grades$"),
                 CallbackQueryHandler(receive_grade, pattern="^load_saved_grades$"),
+                CallbackQueryHandler(receive_grade, pattern="^plan$"),
+            ],
+            PLAN_GRADES: [ # state to plan the grades needed for a target average
+                MessageHandler(filters.TEXT & ~filters.COMMAND, plan_grades),
+                CallbackQueryHandler(plan_grades, pattern="^go_back$"),
             ],
             # state to choose the course type
             CHOOSE_COURSE_TYPE: [
@@ -462,8 +632,20 @@ def main():
         ] + common_commands_and_unknown_command_handling
     )
 
+    # admission control runs before the conversation handler
+    app.add_handler(TypeHandler(Update, admission_control_handler), group=-1)
     app.add_handler(conv_handler)
-    app.run_polling()
+    return app
+
+def main():
+    """Main function to run the bot."""
+    setup_logging()  # opens the log files
+    workers = get_workers()
+    if workers:  # if the bot runs as a sharded deployment
+        from sharding import run_sharded
+        run_sharded(workers)
+    else:
+        build_application().run_polling()
 
 
 if __name__ == '__main__':
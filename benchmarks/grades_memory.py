@@ -0,0 +1,49 @@
+# Average Bot - Telegram Bot for GPA Calculation
+# Author: Gal Levi
+# Date: May 2025
+# License: MIT
+# Version: 3.0
+# Description: This file measures the memory used by the grades of many concurrent sessions.
+# Run from the project's root directory: python benchmarks/grades_memory.py
+
+import os
+import random
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from grade_list import GradeList
+
+SESSIONS = 100_000 # the number of concurrent sessions
+GRADES_PER_SESSION = 12 # the number of grades in each session
+DESCRIPTIONS = ["", "", "", "אלגברה לינארית", "מבני נתונים", "חדו\"א 1"] # mostly without a description
+
+
+def make_grades(rng : random.Random) -> list:
+    """Returns the grades of a session as they are parsed from the user's input."""
+    # the descriptions are copied so they are separate objects, like the ones parsed from different messages
+    return [("".join(rng.choice(DESCRIPTIONS)), float(rng.randint(60, 100)), float(rng.randint(1, 8)),
+             rng.random() < 0.3) for _ in range(GRADES_PER_SESSION)]
+
+
+def measure(build) -> int:
+    """Returns the memory in bytes that is held by the sessions that build creates."""
+    rng = random.Random(0)
+    tracemalloc.start()
+    sessions = [build(make_grades(rng)) for _ in range(SESSIONS)]
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del sessions
+    return current
+
+
+def main():
+    list_memory = measure(list)
+    grade_list_memory = measure(GradeList)
+    print(f"{SESSIONS} sessions with {GRADES_PER_SESSION} grades each:")
+    print(f"list of tuples: {list_memory / 2 ** 20:.1f} MiB")
+    print(f"GradeList:      {grade_list_memory / 2 ** 20:.1f} MiB ({list_memory / grade_list_memory:.1f}x smaller)")
+
+
+if __name__ == '__main__':
+    main()
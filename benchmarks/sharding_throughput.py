@@ -0,0 +1,196 @@
+# Average Bot - Telegram Bot for GPA Calculation
+# Author: Gal Levi
+# Date: May 2025
+# License: MIT
+# Version: 3.0
+# Description: This file measures how the throughput of the sharded deployment scales with the number of workers.
+# The updates go through the real path: the webhook dispatcher, the worker processes with the bot's application
+# and its handlers, and the database. The replies go to a local bot api server that answers after
+# BOT_API_LATENCY seconds, like a round trip to telegram. Every user waits for the bot's answer before he sends
+# his next update, so the workers' update queues stay below the admission control's shedding threshold.
+# With the default latency most of the gain comes from overlapping the bot api latency across the processes,
+# which a single process with concurrent updates would also gain, and it shows even on a single CPU.
+# BOT_API_LATENCY=0 leaves only the CPU work of the dispatcher, the handlers and the database, so it measures
+# how the workers use more cores. The fake bot api and the users share the benchmark's process, keep a core for it.
+# Run from the project's root directory: python benchmarks/sharding_throughput.py
+
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from urllib.parse import parse_qs
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+API_PORT = 18081 # the port of the local bot api server
+os.environ.update(BOT_TOKEN="1:benchmark", ADMIN_TELEGRAM_ID="1", WEBHOOK_SECRET="benchmark",
+                  BOT_API_URL=f"http://127.0.0.1:{API_PORT}/bot")
+import sharding
+from db import setup_database
+from utils import MAX_PENDING_UPDATES
+
+USERS = 400 # the number of users, each one calculates his average from the start
+CONCURRENT_USERS = 100 # the number of users that talk to the bot at the same time
+ANSWER_TIMEOUT = 30 # the maximum time a user waits for the bot's answer
+SHUTDOWN_TIMEOUT = 30 # the maximum time the workers have to stop after the dispatcher stops them
+BOT_API_LATENCY = float(os.getenv("BOT_API_LATENCY", "0.02")) # the time the bot api takes to answer
+WORKER_COUNTS = [1, 2, 4, 8] # the numbers of workers that are measured
+DISPATCHER_PORT = 18080 # the port of the dispatcher
+AVERAGE_TEXT = "🎓 הממוצע" # the beginning of the message with the calculated average
+
+
+def make_conversation(user_id: int) -> list:
+    """Returns the updates of a user who starts the bot, enters grades and calculates his average."""
+    user = {"id": user_id, "is_bot": False, "first_name": "user"}
+    chat = {"id": user_id, "type": "private"}
+
+    def message(text):
+        entities = [{"type": "bot_command", "offset": 0, "length": len(text)}] if text.startswith("/") else []
+        return {"message": {"message_id": 1, "date": 0, "chat": chat, "from": user, "text": text,
+                            "entities": entities}}
+
+    def button(data):
+        return {"callback_query": {"id": str(user_id), "from": user, "chat_instance": "benchmark", "data": data,
+                                   "message": {"message_id": 1, "date": 0, "chat": chat}}}
+
+    return [message("/start"), button("degree_yes"), message("90 5\nאלגברה לינארית 80 4\n95 3"),
+            button("advanced"), button("finished")]
+
+
+class BotApi:
+    """A local bot api server that answers every method, tells the users about answers and counts the averages."""
+
+    def __init__(self):
+        self.averages = 0
+        self.done = asyncio.Event()
+        self.expected = 0
+        self.answered = {} # the events that are set when the bot finishes answering a user's update, by user id
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True: # the bot keeps its connections open between requests
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", "0")))
+                await asyncio.sleep(BOT_API_LATENCY)
+                writer.write(self.answer(request_line.split()[1].decode(), headers, body))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def answer(self, path: str, headers: dict, body: bytes) -> bytes:
+        method = path.rsplit("/", 1)[-1]
+        if "json" in headers.get("content-type", ""):
+            params = json.loads(body or b"{}")
+        else:
+            params = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+        # every step of the conversation ends with a message that has buttons, the messages before it have none
+        if method == "sendMessage" and "reply_markup" in params and int(params["chat_id"]) in self.answered:
+            self.answered[int(params["chat_id"])].set()
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bot", "username": "benchmark_bot"}
+        elif method in ("sendMessage", "editMessageText"):
+            if str(params.get("text", "")).startswith(AVERAGE_TEXT): # the calculated average ends a conversation
+                self.averages += 1
+                if self.averages == self.expected:
+                    self.done.set()
+            result = {"message_id": 1, "date": 0, "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                      "text": params.get("text", "")}
+        else:
+            result = True
+        body = json.dumps({"ok": True, "result": result}).encode()
+        return b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: " + \
+            str(len(body)).encode() + b"\r\n\r\n" + body
+
+
+async def post_update(update: dict) -> None:
+    """Sends an update to the dispatcher like telegram's webhook."""
+    reader, writer = await asyncio.open_connection("127.0.0.1", DISPATCHER_PORT)
+    body = json.dumps(update).encode()
+    writer.write(b"POST / HTTP/1.1\r\nContent-Type: application/json\r\nX-Telegram-Bot-Api-Secret-Token: " +
+                 sharding.WEBHOOK_SECRET.encode() + b"\r\nContent-Length: " + str(len(body)).encode() +
+                 b"\r\n\r\n" + body)
+    await writer.drain()
+    status = await reader.readline()
+    writer.close()
+    assert status.startswith(b"HTTP/1.1 200"), status
+
+
+async def run_users(api: BotApi, first_user_id: int) -> None:
+    """Runs the users' conversations, every user sends his next update after the bot answered the previous one."""
+    semaphore = asyncio.Semaphore(CONCURRENT_USERS)
+
+    async def run_user(user_id):
+        async with semaphore:
+            answered = api.answered[user_id] = asyncio.Event()
+            for update_id, update in enumerate(make_conversation(user_id)):
+                answered.clear()
+                await post_update(dict(update, update_id=update_id))
+                await asyncio.wait_for(answered.wait(), ANSWER_TIMEOUT)
+
+    await asyncio.gather(*(run_user(user_id) for user_id in range(first_user_id, first_user_id + USERS)))
+
+
+async def measure(context, workers: int) -> float:
+    """Returns the number of updates per second that the dispatcher and the given number of workers handle."""
+    api = BotApi()
+    api.expected = USERS
+    api_server = await asyncio.start_server(api.handle, "127.0.0.1", API_PORT)
+    queues = [context.Queue() for _ in range(workers + 1)]
+    last_update = context.RawValue("d", 0.0)
+    processes = [sharding.start_worker(context, shard, queues[shard], last_update) for shard in range(workers + 1)]
+    dispatcher = await asyncio.start_server(
+        lambda reader, writer: sharding.dispatch(queues, workers, last_update, reader, writer),
+        "127.0.0.1", DISPATCHER_PORT)
+    await asyncio.sleep(5) # lets the workers start their applications
+
+    start = time.perf_counter()
+    await run_users(api, first_user_id=2) # the admin's id is 1
+    await asyncio.wait_for(api.done.wait(), ANSWER_TIMEOUT) # waits for the last average to be sent
+    elapsed = time.perf_counter() - start
+
+    for queue in queues: # stops the workers like run_sharded, they have to exit on their own
+        queue.put(None)
+    shutdown_start = time.perf_counter()
+    for process in processes:
+        await asyncio.to_thread(process.join, max(0.0, SHUTDOWN_TIMEOUT - (time.perf_counter() - shutdown_start)))
+    stuck = [process.name for process in processes if process.is_alive()]
+    for process in processes:
+        process.terminate()
+    if stuck or any(process.exitcode for process in processes):
+        raise RuntimeError(f"The workers did not shut down cleanly: {stuck or [p.exitcode for p in processes]}")
+    dispatcher.close()
+    api_server.close()
+    return USERS * len(make_conversation(0)) / elapsed
+
+
+def main():
+    assert CONCURRENT_USERS < MAX_PENDING_UPDATES, "the admission control would shed the benchmark's updates"
+    context = multiprocessing.get_context("spawn")
+    mode = "CPU parallelism" if BOT_API_LATENCY == 0 else "bot api latency overlap"
+    print(f"{USERS} users, {len(make_conversation(0))} updates each, {BOT_API_LATENCY * 1000:.0f} ms bot api latency, "
+          f"measures {mode} ({os.cpu_count()} CPUs):")
+    baseline = None
+    for workers in WORKER_COUNTS:
+        with tempfile.TemporaryDirectory() as cwd: # every run starts with a new database and new log files
+            os.chdir(cwd)
+            os.mkdir("data")
+            setup_database()
+            throughput = asyncio.run(measure(context, workers))
+            os.chdir(ROOT)
+        baseline = baseline or throughput
+        print(f"{workers} workers: {throughput:,.0f} updates per second ({throughput / baseline:.2f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# Average Bot - Telegram Bot for GPA Calculation
+# Author: Gal Levi
+# Date: May 2025
+# License: MIT
+# Version: 3.0
+# Description: This file measures the bot's import time and the allocations of creating the inline buttons.
+# Run from the project's root directory: python benchmarks/startup_and_markups.py
+
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from telegram import InlineKeyboardMarkup, InlineKeyboardButton
+from utils import REPLY_MARKUPS
+
+IMPORT_RUNS = 10 # the number of fresh interpreters that import the bot
+HANDLER_CALLS = 10_000 # the number of simulated handler calls
+
+
+def measure_import() -> tuple:
+    """Returns the median import time of the bot in a fresh interpreter and the files the import created."""
+    code = "import time; start = time.perf_counter(); import average_bot; print(time.perf_counter() - start)"
+    times = []
+    with tempfile.TemporaryDirectory() as cwd:
+        env = dict(os.environ, PYTHONPATH=ROOT)
+        env.pop("ADMIN_TELEGRAM_ID", None) # the import does not need the bot's settings
+        for _ in range(IMPORT_RUNS):
+            output = subprocess.run([sys.executable, "-c", code], cwd=cwd, env=env,
+                                    capture_output=True, text=True, check=True).stdout
+            times.append(float(output))
+        created_files = os.listdir(cwd)
+    return statistics.median(times), created_files
+
+
+def build_course_type_buttons() -> InlineKeyboardMarkup:
+    """Creates the course type buttons the way the handlers created them on every call."""
+    keyboard = [[
+        InlineKeyboardButton("מתקדמים", callback_data="advanced"),
+        InlineKeyboardButton("רגילים", callback_data="regular")
+    ]]
+    return InlineKeyboardMarkup(keyboard)
+
+
+def measure_allocations(get_markup) -> tuple:
+    """Returns the bytes allocated per handler call to get the markup and the time of a call."""
+    start = time.perf_counter()
+    for _ in range(HANDLER_CALLS):
+        get_markup()
+    elapsed = (time.perf_counter() - start) / HANDLER_CALLS
+
+    tracemalloc.start()
+    markups = [get_markup() for _ in range(HANDLER_CALLS)] # keeps the markups so their memory is counted
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (current - sys.getsizeof(markups)) / HANDLER_CALLS, elapsed
+
+
+def main():
+    import_time, created_files = measure_import()
+    print(f"import average_bot: {import_time * 1000:.1f} ms (median of {IMPORT_RUNS} runs)")
+    print(f"files created by the import: {created_files or 'none'}")
+
+    for name, get_markup in [("created per call", build_course_type_buttons),
+                             ("precomputed", lambda: REPLY_MARKUPS["course_type_long"])]:
+        allocated, elapsed = measure_allocations(get_markup)
+        print(f"{name}: {elapsed * 1e6:.2f} us and {max(allocated, 0):.0f} bytes per handler call")
+
+
+if __name__ == '__main__':
+    main()
@@ -7,14 +7,30 @@
 
 import aiosqlite
 import sqlite3
+import time
+import os
 from utils import pack_grades, unpack_grades
+from grade_list import GradeList
 
 PATH = "data/database.db"
+BACKUP_DIR = "data/backups"
+MIN_INDEXED_KEYWORD_LENGTH = 3 # the trigram index finds only keywords of at least 3 characters
+
+# columns that were added to existing tables after their creation: (table, column, definition)
+ADDED_COLUMNS = [
+    ("users", "last_success", "INTEGER"),
+    ("users", "consecutive_failures", "INTEGER NOT NULL DEFAULT 0"),
+    ("users", "blocked", "INTEGER NOT NULL DEFAULT 0"),
+]
 
 def setup_database() -> None:
     """Initializes the database and creates tables if they don't exist."""
     with sqlite3.connect(PATH) as conn:
         cursor = conn.cursor()
+        # enables incremental vacuum, an existing database has to be rebuilt once for the change to apply
+        if cursor.execute("PRAGMA auto_vacuum;").fetchone()[0] != 2:
+            cursor.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+            cursor.execute("VACUUM;")
         cursor.execute("PRAGMA journal_mode=WAL;") # enables write-ahead logging for better performance
         # creates the table if it doesn't exist
         cursor.execute( # creates users table
@@ -27,10 +43,114 @@ def setup_database() -> None:
             )
             """
         )
+        cursor.execute( # creates broadcast jobs table
+            """
+            CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                text TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'running',
+                admin_chat_id INTEGER NOT NULL,
+                progress_message_id INTEGER,
+                total INTEGER NOT NULL DEFAULT 0,
+                sent INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                skipped INTEGER NOT NULL DEFAULT 0,
+                created_at INTEGER NOT NULL
+            )
+            """
+        )
+        cursor.execute( # creates the per-recipient cursor table of the broadcast jobs
+            """
+            CREATE TABLE IF NOT EXISTS broadcast_recipients (
+                job_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                PRIMARY KEY (job_id, user_id)
+            )
+            """
+        )
+        cursor.execute( # creates feedback table
+            """
+            CREATE TABLE IF NOT EXISTS feedback (
+                feedback_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                created_at INTEGER NOT NULL
+            )
+            """
+        )
+        cursor.execute("CREATE INDEX IF NOT EXISTS feedback_created_at ON feedback (created_at)")
+        # creates the full-text search index of the feedback, its content is kept in the feedback table
+        # the index is split into trigrams, so a keyword also matches inside words with hebrew prefix letters
+        cursor.execute(
+            """
+            CREATE VIRTUAL TABLE IF NOT EXISTS feedback_fts
+            USING fts5(text, content='feedback', content_rowid='feedback_id', tokenize='trigram')
+            """
+        )
+        cursor.execute( # keeps the full-text search index updated with every new feedback
+            """
+            CREATE TRIGGER IF NOT EXISTS feedback_fts_insert AFTER INSERT ON feedback BEGIN
+                INSERT INTO feedback_fts (rowid, text) VALUES (new.feedback_id, new.text);
+            END
+            """
+        )
+        # adds the missing columns to databases that were created by an older version
+        for table, column, definition in ADDED_COLUMNS:
+            existing_columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table})").fetchall()]
+            if column not in existing_columns:
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
 
         conn.commit()
 
 
+# maintenance functions, they block and are meant to run on a worker thread
+def get_wal_size() -> int:
+    """Returns the size in bytes of the database's write-ahead log file."""
+    try:
+        return os.path.getsize(PATH + "-wal")
+    except OSError: # the file does not exist when there is no open connection
+        return 0
+
+def checkpoint_wal(mode : str) -> tuple:
+    """Runs a WAL checkpoint (PASSIVE or TRUNCATE), returns (busy, log pages, checkpointed pages)."""
+    with sqlite3.connect(PATH) as conn:
+        return conn.execute(f"PRAGMA wal_checkpoint({mode});").fetchone()
+
+def incremental_vacuum(max_pages : int) -> int:
+    """Frees up to max_pages unused pages of the database file, returns the number of freed pages."""
+    with sqlite3.connect(PATH) as conn:
+        free_pages = conn.execute("PRAGMA freelist_count;").fetchone()[0]
+        if free_pages: # executescript steps the pragma to completion, execute frees a single page
+            conn.executescript(f"PRAGMA incremental_vacuum({max_pages});")
+        return free_pages - conn.execute("PRAGMA freelist_count;").fetchone()[0]
+
+def backup_database(max_backups : int) -> str:
+    """Takes a consistent online backup of the database and keeps only the newest backups, returns its path."""
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    backup_path = os.path.join(BACKUP_DIR, time.strftime("database-%Y%m%d-%H%M%S.db"))
+    source = sqlite3.connect(PATH)
+    destination = sqlite3.connect(backup_path)
+    try:
+        # copies the whole database in a single step, a backup in steps restarts whenever the bot writes
+        # between the steps, and in WAL mode the backup's reading does not lock out the bot's writes
+        source.backup(destination)
+    finally:
+        destination.close()
+        source.close()
+
+    for old_backup in get_backups()[:-max_backups]: # removes the oldest backups
+        os.remove(old_backup)
+    return backup_path
+
+def get_backups() -> list:
+    """Returns the paths of the database backups, the oldest first."""
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    return sorted(os.path.join(BACKUP_DIR, name) for name in os.listdir(BACKUP_DIR)
+                  if name.startswith("database-") and name.endswith(".db"))
+
+
 async def update_last_grades(user_id : int, last_grades : list) -> None:
     """Updates the last entered grades of a user."""
     async with aiosqlite.connect(PATH) as conn:
@@ -49,7 +169,7 @@ async def update_last_grades(user_id : int, last_grades : list) -> None:
         await conn.commit()
 
 
-async def get_last_grades(user_id : int) -> list:
+async def get_last_grades(user_id : int) -> GradeList:
     """Retrieves the last entered grades of a user."""
     async with aiosqlite.connect(PATH) as conn:
         cursor = await conn.cursor()
@@ -57,7 +177,7 @@ async def get_last_grades(user_id : int) -> list:
         await cursor.execute("SELECT last_grades FROM users WHERE user_id = ?", (user_id,))
         result = await cursor.fetchone() # fetches the first row
 
-    return unpack_grades(result[0]) if result and result[0] else []
+    return unpack_grades(result[0]) if result and result[0] else GradeList()
 
 
 async def update_saved_grades(user_id : int, saved_grades : list) -> None:
@@ -77,7 +197,7 @@ async def update_saved_grades(user_id : int, saved_grades : list) -> None:
 
         await conn.commit()
 
-async def get_saved_grades(user_id : int) -> list:
+async def get_saved_grades(user_id : int) -> GradeList:
     """Retrieves the grades that the user has saved."""
     async with aiosqlite.connect(PATH) as conn:
         cursor = await conn.cursor()
@@ -85,7 +205,7 @@ async def get_saved_grades(user_id : int) -> list:
         await cursor.execute("SELECT saved_grades FROM users WHERE user_id = ?", (user_id,))
         result = await cursor.fetchone()
 
-    return unpack_grades(result[0]) if result and result[0] else []
+    return unpack_grades(result[0]) if result and result[0] else GradeList()
 
 
 async def update_exact_science(user_id : int, exact_science : bool) -> None:
@@ -114,6 +234,25 @@ async def get_exact_science(user_id : int) -> int:
 
     return result[0] if result else -1
 
+async def get_exact_science_and_blocked(user_id : int) -> tuple:
+    """Retrieves the user's choice of exact science and if he is skipped by bulk sends, in a single query."""
+    async with aiosqlite.connect(PATH) as conn:
+        cursor = await conn.cursor()
+
+        await cursor.execute("SELECT exact_science, blocked FROM users WHERE user_id = ?", (user_id,))
+        result = await cursor.fetchone()
+
+    return (result[0], result[1] == 1) if result else (-1, False)
+
+async def unblock_user(user_id : int) -> None:
+    """Marks a user that was skipped by bulk sends as reachable again."""
+    async with aiosqlite.connect(PATH) as conn:
+        cursor = await conn.cursor()
+
+        await cursor.execute("UPDATE users SET blocked = 0, consecutive_failures = 0 WHERE user_id = ?", (user_id,))
+
+        await conn.commit()
+
 async def get_total_users() -> int:
     """Retrieves the total number of users."""
     async with aiosqlite.connect(PATH) as conn:
@@ -124,22 +263,229 @@ async def get_total_users() -> int:
 
     return result[0] if result else 0
 
-async def get_all_users_ids() -> list:
-    """Retrieves all user IDs."""
+async def user_exists(user_id : int) -> bool:
+    """Checks if a user exists in the database."""
+    async with aiosqlite.connect(PATH) as conn:
+        cursor = await conn.cursor()
+
+        await cursor.execute("SELECT COUNT(*) FROM users WHERE user_id = ?", (user_id,))
+        result = await cursor.fetchone()
+
+    return result[0] > 0 if result else False
+
+async def create_broadcast_job(text : str, admin_chat_id : int) -> tuple:
+    """Creates a broadcast job with a recipient row for every user, returns the job id and the total recipients."""
+    async with aiosqlite.connect(PATH) as conn:
+        cursor = await conn.cursor()
+
+        await cursor.execute(
+            "INSERT INTO broadcast_jobs (text, admin_chat_id, created_at) VALUES (?, ?, ?)",
+            (text, admin_chat_id, int(time.time()))
+        )
+        job_id = cursor.lastrowid
+        # snapshots the reachable recipients so a resumed job sends to the same users
+        await cursor.execute(
+            "INSERT INTO broadcast_recipients (job_id, user_id) SELECT ?, user_id FROM users WHERE blocked = 0",
+            (job_id,)
+        )
+        total = cursor.rowcount
+        await cursor.execute(
+            """
+            UPDATE broadcast_jobs SET total = ?, skipped = (SELECT COUNT(*) FROM users WHERE blocked = 1)
+            WHERE job_id = ?
+            """, (total, job_id)
+        )
+
+        await conn.commit()
+
+    return job_id, total
+
+async def set_broadcast_progress_message(job_id : int, message_id : int) -> None:
+    """Stores the id of the admin's message that shows the job's progress."""
+    async with aiosqlite.connect(PATH) as conn:
+        cursor = await conn.cursor()
+
+        await cursor.execute(
+            "UPDATE broadcast_jobs SET progress_message_id = ? WHERE job_id = ?", (message_id, job_id)
+        )
+
+        await conn.commit()
+
+async def get_broadcast_job(job_id : int) -> tuple:
+    """
+    Retrieves a broadcast job:
+    (job_id, text, status, admin_chat_id, progress_message_id, total, sent, failed, skipped).
+    Returns None if the job does not exist.
+    """
+    async with aiosqlite.connect(PATH) as conn:
+        cursor = await conn.cursor()
+
+        await cursor.execute(
+            """
+            SELECT job_id, text, status, admin_chat_id, progress_message_id, total, sent, failed, skipped
+            FROM broadcast_jobs WHERE job_id = ?
+            """, (job_id,)
+        )
+        result = await cursor.fetchone()
+
+    return result
+
+async def get_last_broadcast_job_id() -> int:
+    """Retrieves the id of the most recent broadcast job, returns -1 if there are none."""
+    async with aiosqlite.connect(PATH) as conn:
+        cursor = await conn.cursor()
+
+        await cursor.execute("SELECT MAX(job_id) FROM broadcast_jobs")
+        result = await cursor.fetchone()
+
+    return result[0] if result and result[0] is not None else -1
+
+async def get_running_broadcast_jobs_ids() -> list:
+    """Retrieves the ids of the broadcast jobs that were not finished or cancelled."""
+    async with aiosqlite.connect(PATH) as conn:
+        cursor = await conn.cursor()
+
+        await cursor.execute("SELECT job_id FROM broadcast_jobs WHERE status = 'running' ORDER BY job_id")
+        result = await cursor.fetchall()
+
+    return [job[0] for job in result] if result else []
+
+async def get_pending_broadcast_recipients(job_id : int, limit : int) -> list:
+    """Retrieves the next batch of users that did not receive the broadcast yet."""
     async with aiosqlite.connect(PATH) as conn:
         cursor = await conn.cursor()
 
-        await cursor.execute("SELECT user_id FROM users")
+        await cursor.execute(
+            """
+            SELECT user_id FROM broadcast_recipients
+            WHERE job_id = ? AND status = 'pending'
+            ORDER BY user_id LIMIT ?
+            """, (job_id, limit)
+        )
         result = await cursor.fetchall()
 
     return [user[0] for user in result] if result else []
 
-async def user_exists(user_id : int) -> bool:
-    """Checks if a user exists in the database."""
+async def update_delivery_status(cursor : aiosqlite.Cursor, results : list) -> None:
+    """
+    Records the delivery results (user_id, is_sent, is_unreachable) in the users table.
+    Every failure is counted until the next success, but a user is blocked only when he is permanently unreachable.
+    """
+    now = int(time.time())
+    await cursor.executemany(
+        "UPDATE users SET last_success = ?, consecutive_failures = 0 WHERE user_id = ?",
+        [(now, user_id) for user_id, is_sent, _ in results if is_sent]
+    )
+    await cursor.executemany(
+        """
+        UPDATE users SET consecutive_failures = consecutive_failures + 1, blocked = MAX(blocked, ?) WHERE user_id = ?
+        """, [(1 if is_unreachable else 0, user_id) for user_id, is_sent, is_unreachable in results if not is_sent]
+    )
+
+async def record_delivery_results(results : list) -> None:
+    """Records the delivery results (user_id, is_sent, is_unreachable) of messages sent outside a broadcast job."""
     async with aiosqlite.connect(PATH) as conn:
         cursor = await conn.cursor()
 
-        await cursor.execute("SELECT COUNT(*) FROM users WHERE user_id = ?", (user_id,))
+        await update_delivery_status(cursor, results)
+
+        await conn.commit()
+
+async def checkpoint_broadcast_recipients(job_id : int, results : list) -> None:
+    """Records the delivery results (user_id, is_sent, is_unreachable) of a batch and updates the job's counters."""
+    async with aiosqlite.connect(PATH) as conn:
+        cursor = await conn.cursor()
+
+        await cursor.executemany(
+            "UPDATE broadcast_recipients SET status = ? WHERE job_id = ? AND user_id = ?",
+            [("sent" if is_sent else "failed", job_id, user_id) for user_id, is_sent, _ in results]
+        )
+        sent = sum(1 for _, is_sent, _ in results if is_sent)
+        await cursor.execute(
+            "UPDATE broadcast_jobs SET sent = sent + ?, failed = failed + ? WHERE job_id = ?",
+            (sent, len(results) - sent, job_id)
+        )
+        await update_delivery_status(cursor, results)
+
+        await conn.commit() # the results of the batch, the counters and the users' delivery status are saved together
+
+async def get_total_blocked_users() -> int:
+    """Retrieves the number of users that are skipped by bulk sends."""
+    async with aiosqlite.connect(PATH) as conn:
+        cursor = await conn.cursor()
+
+        await cursor.execute("SELECT COUNT(*) FROM users WHERE blocked = 1")
         result = await cursor.fetchone()
 
-    return result[0] > 0 if result else False
+    return result[0] if result else 0
+
+async def update_broadcast_job_status(job_id : int, status : str) -> bool:
+    """Updates the status of a running broadcast job, returns False if the job is not running."""
+    async with aiosqlite.connect(PATH) as conn:
+        cursor = await conn.cursor()
+
+        await cursor.execute(
+            "UPDATE broadcast_jobs SET status = ? WHERE job_id = ? AND status = 'running'", (status, job_id)
+        )
+        updated = cursor.rowcount > 0
+
+        await conn.commit()
+
+    return updated
+
+async def insert_feedbacks(feedbacks : list) -> None:
+    """Inserts a batch of feedbacks (user_id, text, created_at) in a single transaction."""
+    async with aiosqlite.connect(PATH) as conn:
+        cursor = await conn.cursor()
+
+        await cursor.executemany("INSERT INTO feedback (user_id, text, created_at) VALUES (?, ?, ?)", feedbacks)
+
+        await conn.commit()
+
+def get_feedback_filter(keyword : str, start : int, end : int) -> tuple:
+    """Builds the FROM and WHERE clauses and their parameters for filtering feedbacks by keyword and date range."""
+    query = "FROM feedback"
+    conditions = []
+    params = []
+    if len(keyword) >= MIN_INDEXED_KEYWORD_LENGTH: # searches the keyword anywhere in the text through the index
+        query += " JOIN feedback_fts ON feedback_fts.rowid = feedback.feedback_id"
+        conditions.append("feedback_fts MATCH ?")
+        params.append('"' + keyword.replace('"', '""') + '"')
+    elif keyword: # a shorter keyword is searched without the index
+        conditions.append("instr(feedback.text, ?) > 0")
+        params.append(keyword)
+    if start is not None:
+        conditions.append("feedback.created_at >= ?")
+        params.append(start)
+    if end is not None:
+        conditions.append("feedback.created_at < ?")
+        params.append(end)
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+
+    return query, params
+
+async def search_feedbacks(keyword : str, start : int, end : int, limit : int, offset : int) -> list:
+    """Retrieves a page of feedbacks (feedback_id, user_id, text, created_at), the newest first."""
+    query, params = get_feedback_filter(keyword, start, end)
+    async with aiosqlite.connect(PATH) as conn:
+        cursor = await conn.cursor()
+
+        await cursor.execute(
+            "SELECT feedback.feedback_id, feedback.user_id, feedback.text, feedback.created_at " + query +
+            " ORDER BY feedback.feedback_id DESC LIMIT ? OFFSET ?", params + [limit, offset]
+        )
+        result = await cursor.fetchall()
+
+    return list(result) if result else []
+
+async def count_feedbacks(keyword : str, start : int, end : int) -> int:
+    """Retrieves the number of feedbacks that match the keyword and the date range."""
+    query, params = get_feedback_filter(keyword, start, end)
+    async with aiosqlite.connect(PATH) as conn:
+        cursor = await conn.cursor()
+
+        await cursor.execute("SELECT COUNT(*) " + query, params)
+        result = await cursor.fetchone()
+
+    return result[0] if result else 0
@@ -0,0 +1,78 @@
+# Average Bot - Telegram Bot for GPA Calculation
+# Author: Gal Levi
+# Date: May 2025
+# License: MIT
+# Version: 3.0
+# Description: This file contains the compact representation of the grades kept in the users' sessions.
+
+from array import array
+import sys
+
+
+class GradeList:
+    """
+    A list of grades (description, grade, credit, is_advanced) stored in parallel byte columns.
+    Grades (60-100) and credits (1-8) always fit in a byte, and the descriptions are interned
+    so the repeated ones (mostly the empty description) are shared between all the sessions.
+    """
+
+    __slots__ = ("descs", "grades", "credits", "advanced")
+
+    def __init__(self, grades=()):
+        self.descs = [] # the interned descriptions
+        self.grades = array("B")
+        self.credits = array("B")
+        self.advanced = array("B")
+        self.extend(grades)
+
+    def append(self, grade : tuple) -> None:
+        """Adds a grade (description, grade, credit, is_advanced) to the end of the list."""
+        desc, grade, credit, is_advanced = grade
+        self.descs.append(sys.intern(desc))
+        self.grades.append(int(grade))
+        self.credits.append(int(credit))
+        self.advanced.append(1 if is_advanced else 0)
+
+    def extend(self, grades) -> None:
+        """Adds the grades to the end of the list."""
+        for grade in grades:
+            self.append(grade)
+
+    def pop(self, index : int = -1) -> tuple:
+        """Removes the grade in the index and returns it."""
+        grade = self[index]
+        del self.descs[index]
+        self.grades.pop(index)
+        self.credits.pop(index)
+        self.advanced.pop(index)
+        return grade
+
+    def __iadd__(self, grades):
+        self.extend(grades)
+        return self
+
+    def __len__(self) -> int:
+        return len(self.grades)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice): # a slice of the grades is a GradeList as well, like a slice of a list
+            sliced = GradeList()
+            sliced.descs = self.descs[index]
+            sliced.grades = self.grades[index]
+            sliced.credits = self.credits[index]
+            sliced.advanced = self.advanced[index]
+            return sliced
+        return self.descs[index], self.grades[index], self.credits[index], self.advanced[index] == 1
+
+    def __iter__(self):
+        for desc, grade, credit, is_advanced in zip(self.descs, self.grades, self.credits, self.advanced):
+            yield desc, grade, credit, is_advanced == 1
+
+    def __eq__(self, other) -> bool:
+        # compares by value so a list of grades loaded from the database equals the same grades in a session
+        if isinstance(other, (GradeList, list)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"GradeList({list(self)!r})"
@@ -0,0 +1,197 @@
+# Average Bot - Telegram Bot for GPA Calculation
+# Author: Gal Levi
+# Date: May 2025
+# License: MIT
+# Version: 3.0
+# Description: This file contains the sharded deployment of the bot over several processes.
+# A dispatcher receives the updates through a webhook and passes each update to a worker process
+# by its user id, so every worker keeps the sessions of its own users.
+# The admin's updates and the updates without a user go to the coordinator, which also runs
+# the broadcasts and the database maintenance.
+
+import asyncio
+import hmac
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import time
+from utils import get_token, get_admin_id, get_bot_api_url, setup_logging, log_user
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") # the public https url that telegram sends the updates to
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") # the secret token telegram sends with every update, required
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0") # the address the dispatcher listens on
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443")) # the port the dispatcher listens on
+SUPERVISE_INTERVAL = 5 # the time between two checks that all the worker processes are alive
+QUEUE_POLL_INTERVAL = 1 # the maximum time a worker waits for an update before it checks the queue again
+COORDINATOR = 0 # the shard of the coordinator, the workers' shards are 1 to the number of workers
+MAX_UPDATE_SIZE = 1024 * 1024 # the maximum size in bytes of an update's body
+
+# the keys of an update that hold the user who sent it
+UPDATE_USER_KEYS = ("message", "edited_message", "callback_query", "inline_query", "chosen_inline_result",
+                    "shipping_query", "pre_checkout_query", "poll_answer", "my_chat_member", "chat_member",
+                    "chat_join_request")
+
+
+def get_update_user_id(update: dict) -> int:
+    """Returns the id of the user who sent the update, None if the update has no user."""
+    for key in UPDATE_USER_KEYS:
+        if key in update:
+            user = update[key].get("from") or update[key].get("user")
+            return user["id"] if user else None
+    return None
+
+
+def get_shard(user_id: int, workers: int) -> int:
+    """Returns the shard that handles the user's updates, always the same one for the same user."""
+    if user_id is None or user_id == get_admin_id():
+        return COORDINATOR
+    return 1 + user_id % workers
+
+
+async def run_worker(updates: multiprocessing.Queue, is_coordinator: bool, last_update) -> None:
+    """
+    Processes the updates the dispatcher passes to the worker until it gets None.
+    last_update is the shared time the dispatcher received its last update.
+    """
+    from telegram import Update
+    from average_bot import build_application, post_init, post_stop, post_shutdown
+    app = build_application(is_coordinator=is_coordinator, with_updater=False,
+                            last_activity=lambda: last_update.value)
+    async with app: # initializes and shuts down the application
+        await app.start()
+        # the hooks run by run_polling have to be called by the worker itself, the background work they start
+        # is not tracked by the application, so app.stop() does not wait for it and post_shutdown stops it
+        await post_init(app)
+        while True:
+            try: # waits for the next update without blocking the bot, the thread never outlives the worker for long
+                data = await asyncio.to_thread(updates.get, timeout=QUEUE_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if data is None: # if the dispatcher is shutting down
+                break
+            try:
+                update = Update.de_json(data, app.bot)
+            except Exception as e: # a malformed update must not stop the worker
+                log_user(get_admin_id(), f"sent a malformed update that was dropped by a worker: {e}")
+                continue
+            await app.update_queue.put(update)
+        await app.stop()
+        await post_stop(app)
+        await post_shutdown(app)
+
+
+def worker_process(shard: int, updates: multiprocessing.Queue, last_update) -> None:
+    """The entry point of a worker process."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # the dispatcher stops the workers with None
+    setup_logging()
+    asyncio.run(run_worker(updates, shard == COORDINATOR, last_update))
+
+
+def start_worker(context, shard: int, updates: multiprocessing.Queue, last_update) -> multiprocessing.Process:
+    """Starts the process of a shard."""
+    process = context.Process(target=worker_process, args=(shard, updates, last_update),
+                              name=f"average-bot-shard-{shard}")
+    process.start()
+    return process
+
+
+async def read_request(reader: asyncio.StreamReader) -> tuple:
+    """Reads an http request, returns its headers (lower case names) and its body."""
+    request_line = await reader.readline()
+    if not request_line.startswith(b"POST "):
+        raise ValueError("Only POST requests are supported")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""): # the headers end with an empty line
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", "0"))
+    if length > MAX_UPDATE_SIZE:
+        raise ValueError("The update is too large")
+    return headers, await reader.readexactly(length)
+
+
+async def dispatch(queues: list, workers: int, last_update,
+                   reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """Receives an update from telegram and passes it to the shard of its user."""
+    status = b"200 OK"
+    try:
+        headers, body = await read_request(reader)
+        secret = headers.get("x-telegram-bot-api-secret-token", "")
+        if not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()): # takes the same time for any secret
+            status = b"403 Forbidden"
+        else:
+            update = json.loads(body)
+            if not isinstance(update, dict):
+                raise ValueError("An update has to be a json object")
+            queues[get_shard(get_update_user_id(update), workers)].put(update)
+            last_update.value = time.time() # the coordinator's database maintenance waits for the bot to be idle
+    except Exception: # a malformed request is answered and does not reach the workers
+        status = b"400 Bad Request"
+    writer.write(b"HTTP/1.1 " + status + b"\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+    try:
+        await writer.drain()
+    except ConnectionError: # telegram closed the connection before the response
+        pass
+    finally:
+        writer.close()
+
+
+async def supervise(context, processes: list, queues: list, last_update) -> None:
+    """
+    Restarts the worker processes that stopped with a new queue.
+    A worker that died while reading its queue keeps the queue's lock forever, so its queued updates are dropped.
+    """
+    while True:
+        await asyncio.sleep(SUPERVISE_INTERVAL)
+        for shard, process in enumerate(processes):
+            if not process.is_alive():
+                log_user(get_admin_id(), f"shard {shard} stopped with exit code {process.exitcode} and is restarted")
+                queues[shard].cancel_join_thread() # nobody reads the old queue, so the dispatcher must not wait for it
+                queues[shard].close()
+                queues[shard] = context.Queue() # the dispatcher passes the next updates of the shard to the new queue
+                processes[shard] = start_worker(context, shard, queues[shard], last_update)
+
+
+async def run_dispatcher(context, processes: list, queues: list, workers: int, last_update) -> None:
+    """Registers the webhook and passes the updates to the shards until the dispatcher is stopped."""
+    from telegram import Bot, Update
+    async with Bot(get_token(), base_url=get_bot_api_url()) as bot:
+        await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES)
+
+    server = await asyncio.start_server(lambda reader, writer: dispatch(queues, workers, last_update, reader, writer),
+                                        WEBHOOK_HOST, WEBHOOK_PORT)
+    supervisor = asyncio.create_task(supervise(context, processes, queues, last_update))
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for stop_signal in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(stop_signal, stop.set)
+    async with server:
+        await stop.wait()
+    supervisor.cancel()
+
+
+def run_sharded(workers: int) -> None:
+    """Runs the bot as a dispatcher with a coordinator and the given number of worker processes."""
+    from db import setup_database
+    if not WEBHOOK_URL:
+        raise ValueError("WEBHOOK_URL has to be set to run the bot with several workers")
+    if not WEBHOOK_SECRET: # without it anyone who knows the url could send updates as the admin
+        raise ValueError("WEBHOOK_SECRET has to be set to run the bot with several workers")
+    setup_database() # the database is created once before the processes use it
+
+    context = multiprocessing.get_context("spawn") # every worker starts with its own clean interpreter
+    queues = [context.Queue() for _ in range(workers + 1)]
+    last_update = context.RawValue("d", 0.0) # the time of the last update, shared with the coordinator
+    processes = [start_worker(context, shard, queues[shard], last_update) for shard in range(workers + 1)]
+    try:
+        asyncio.run(run_dispatcher(context, processes, queues, workers, last_update))
+    finally:
+        for queue in queues: # lets the workers finish the updates they already got
+            queue.put(None)
+        for process in processes:
+            process.join()
@@ -7,22 +7,58 @@
 
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton, Bot
 from telegram.ext import CallbackContext
+from telegram.error import TelegramError, Forbidden, BadRequest, RetryAfter
 import os
+import time
+import functools
+from types import MappingProxyType
 import asyncio
 import logging
+import sqlite3
+from grade_list import GradeList
+from datetime import datetime, timedelta
 
 # constants for the states of the conversation
 (ASK_DEGREE, ENTER_GRADE, CHOOSE_COURSE_TYPE,
  DELETE_GRADE, SAVE_GRADES, WRITE_FEEDBACK,
- WRITE_BROADCAST_MSG, GET_ID_FOR_PRIVATE_MESSAGE, WRITE_PRIVATE_MSG) = range(9)
+ WRITE_BROADCAST_MSG, GET_ID_FOR_PRIVATE_MESSAGE, WRITE_PRIVATE_MSG,
+ PLAN_GRADES) = range(10)
 
 # constants for the bot's logic
 ADVANCED_COURSE = 1.5 # the weight of an advanced course
-TOKEN = os.getenv("BOT_TOKEN") # the token for the bot
-ADMIN_ID = int(os.getenv("ADMIN_TELEGRAM_ID")) # the id of the admin
 ACTIVE_USERS = {} # a dictionary to store the active users
 SLEEP_TIME = 0.1 # the time to sleep between sending broadcast messages
+BROADCAST_BATCH_SIZE = 25 # the number of recipients sent between two checkpoints of a broadcast job
+BROADCAST_TASKS = {} # a dictionary to store the running broadcast jobs' tasks by job id
+BACKGROUND_TASKS = {} # a dictionary to store the bot's long-running background tasks by name
+FEEDBACK_QUEUE = asyncio.Queue() # the feedbacks waiting to be written to the database
+FEEDBACK_BATCH_SIZE = 50 # the maximum number of feedbacks written in a single transaction
+FEEDBACK_FLUSH_INTERVAL = 1 # the time to wait for more feedbacks before writing a batch
+FEEDBACK_WRITE_ATTEMPTS = 5 # the number of times a batch is written while the database is locked by another shard
+FEEDBACK_RETRY_DELAY = 1 # the time to wait before writing a batch again after the database was locked
+FEEDBACK_PAGE_SIZE = 10 # the number of feedbacks shown in a single page
+MAX_FEEDBACK_PREVIEW_LENGTH = 300 # the maximum length of a feedback shown in a page
+MAINTENANCE_INTERVAL = 60 # the time between two runs of the database maintenance
+WAL_PASSIVE_CHECKPOINT_SIZE = 4 * 1024 * 1024 # the WAL size in bytes from which a passive checkpoint is run
+WAL_TRUNCATE_CHECKPOINT_SIZE = 64 * 1024 * 1024 # the WAL size in bytes from which the WAL is truncated
+IDLE_TIME = 60 # the time without updates after which the bot is idle and can be vacuumed
+VACUUM_PAGES = 500 # the maximum number of pages freed by an incremental vacuum in a single idle window
+BACKUP_INTERVAL = 24 * 60 * 60 # the time between two backups of the database
+MAX_BACKUPS = 7 # the number of backups that are kept
+RATE_LIMIT_BURST = 10 # the number of updates a user can send at once before he is slowed down
+RATE_LIMIT_PER_SECOND = 1 # the rate in which a user's updates allowance is refilled
+LINES_PER_TOKEN = 10 # a message costs one more update from the allowance for every this many lines
+MAX_PENDING_UPDATES = 200 # the number of waiting updates from which new updates are shed
+SLOW_DOWN_REPLY_INTERVAL = 30 # the minimum time between two slow down replies to the same user
+MAX_RATE_LIMITED_USERS = 10000 # the number of users tracked by the rate limiter before idle users are removed
+LAST_ACTIVITY = {"time": 0.0} # the time the bot received its last update
+RATE_LIMIT_BUCKETS = {} # a dictionary to store the users' (tokens, last update time, last slow down reply time)
+MAX_INPUT_LINES = RATE_LIMIT_BURST * LINES_PER_TOKEN # the maximum number of lines of a single message
+SHED_COUNTERS = {"rate_limited": 0, "overloaded": 0, "too_long": 0} # counters of the updates that were shed by reason
 MAX_DESC_LENGTH = 25 # the maximum length of the description
+MIN_GRADE, MAX_GRADE = 60, 100 # the range of a passing grade
+MIN_CREDIT, MAX_CREDIT = 1, 8 # the range of credits of a single course
+PLAN_GRADES_RANGE = range(MIN_GRADE, MAX_GRADE + 1) # the possible grades evaluated by the planner
 
 # constants for the bot's messages
 START_TEXT = "🎓 שלום! אני יודע לחשב ממוצע באוניברסיטה הפתוחה.\nאשמח לעזור לך לחשב את הממוצע שלך."
@@ -86,19 +122,60 @@ FEEDBACK_ACKNOWLEDGEMENT = "✅ המשוב שלך נשמר במערכת בהצל
 FEEDBACK_EXIT = "❌ בחרת לא לכתוב פידבק."
 BROADCAST_MSG = "📢 אנא כתוב את ההודעה שברצונך לשלוח לכל המשתמשים."
 BROADCAST_ACKNOWLEDGEMENT = "✅ ההודעה נשלחה בהצלחה לכל המשתמשים."
+BROADCAST_JOB_PROGRESS = "📢 משימה #{job_id}: ההודעה נשלחה ל-{sent} מתוך {total} משתמשים ({failed} נכשלו, {skipped} דולגו כי אינם זמינים)."
+BROADCAST_JOB_DONE = "✅ משימה #{job_id} הסתיימה: ההודעה נשלחה בהצלחה ל-{sent} מתוך {total} משתמשים ({failed} נכשלו, {skipped} דולגו כי אינם זמינים)."
+BROADCAST_JOB_CANCELLED = "🛑 משימה #{job_id} בוטלה: ההודעה נשלחה ל-{sent} מתוך {total} משתמשים ({failed} נכשלו, {skipped} דולגו כי אינם זמינים)."
+BROADCAST_JOB_STATUS = "📊 משימה #{job_id} ({status}): ההודעה נשלחה ל-{sent} מתוך {total} משתמשים ({failed} נכשלו, {skipped} דולגו כי אינם זמינים)."
+BROADCAST_JOB_NOT_FOUND = "❌ לא נמצאה משימת שליחה עם המזהה הזה."
+BROADCAST_JOB_ID_ERROR = "❌ מזהה משימה שגוי. למשל: /cancel_broadcast 3"
+BROADCAST_JOB_NOT_RUNNING = "❌ משימה #{job_id} כבר אינה פעילה."
+BROADCAST_JOB_CANCEL_REQUESTED = "🛑 משימה #{job_id} תיעצר בנקודת השמירה הבאה."
+BLOCKED_USERS_REPORT = "🚫 {blocked} משתמשים אינם זמינים ומדולגים בשליחות המוניות."
+FEEDBACKS_HEADER = "📝 נמצאו {count} משובים (עמוד {page} מתוך {pages}):\n\n"
+FEEDBACKS_COUNT = "📝 נמצאו {count} משובים."
+NO_FEEDBACKS_FOUND = "❌ לא נמצאו משובים."
+FEEDBACK_QUERY_ERROR = ("❌ קלט שגוי! ניתן לסנן לפי מילת חיפוש, טווח תאריכים ועמוד.\n"
+                        "למשל:\n"
+                        "/feedbacks ממוצע 2025-05-01 2025-06-01 #2\n"
+                        "/feedback_count 2025-05-01")
+SLOW_DOWN = "⏳ יותר מדי הודעות בזמן קצר, אנא המתן מעט ונסה שוב."
+INPUT_TOO_LONG = f"❌ ההודעה ארוכה מדי. אנא שלח עד {MAX_INPUT_LINES} שורות בכל הודעה."
+ADMISSION_STATS = ("📊 עדכונים שנדחו:\n"
+                   "בגלל הגבלת קצב למשתמש: {rate_limited}\n"
+                   "בגלל הודעה ארוכה מדי: {too_long}\n"
+                   "בגלל עומס כללי: {overloaded}\n"
+                   "משתמשים במעקב: {tracked}")
+BROADCAST_STATUS_NAMES = {"running": "בתהליך", "done": "הסתיימה", "cancelled": "בוטלה"}
 ASK_ID_FOR_PRIVATE_MSG = "📩 אנא הכנס את מזהה המשתמש שברצונך לשלוח לו הודעה."
 PRIVATE_MSG = "📩 אנא כתוב את ההודעה שברצונך לשלוח למשתמש."
 SINGLE_ACKNOWLEDGEMENT = "✅ ההודעה נשלחה בהצלחה למשתמש."
 ID_NOT_FOUND_ERROR = "❌ לא נמצא משתמש עם המזהה הזה במערכת.\nאנא נסה שוב."
 WRONG_ID_ERROR = "❌ מזהה שגוי. אנא הכנס מזהה תקין."
 WRONG_DESC_LENGTH_ERROR = f"❌ תיאור ארוך מדי. אנא הקלד תיאור עד {MAX_DESC_LENGTH} תווים."
+PLAN_PROMPT = ("🎯 אנא הכנס את ממוצע היעד בשורה הראשונה ואת הקורסים המתוכננים בשורות הבאות בפורמט הבא:\n"
+               "<נק\"ז> <מתקדם>(אופציונלי)\n"
+               "למשל:\n"
+               "85\n"
+               "5\n"
+               "4 מתקדם\n"
+               "הציונים שהוזנו עד כה יילקחו בחשבון.")
+PLAN_FORMAT_ERROR = ("❌ קלט שגוי! אנא הכנס ממוצע יעד ולאחריו לפחות קורס מתוכנן אחד.\n"
+                     "למשל:\n"
+                     "85\n"
+                     "4 מתקדם\n")
+PLAN_RANGE_ERROR = f"❌ קלט שגוי! ממוצע היעד צריך להיות בין {MIN_GRADE} ל-{MAX_GRADE} ונק\"ז מ{MIN_CREDIT} עד {MAX_CREDIT} בלבד. אנא נסה שוב."
+PLAN_ALREADY_REACHED = "✅ גם עם ציון {grade} בכל הקורסים המתוכננים תגיע לממוצע {average:.2f}, שעומד ביעד {target:g}."
+PLAN_UNREACHABLE = "❌ גם עם ציון {grade} בכל הקורסים המתוכננים תגיע לממוצע {average:.2f} בלבד, ולא ליעד {target:g}."
+PLAN_REQUIRED_GRADE = "🎯 כדי להגיע לממוצע {target:g} עלייך לקבל לפחות {grade} בכל הקורסים המתוכננים (ממוצע צפוי: {average:.2f})."
+WAITING_FOR_PLAN = "מחכה ליעד..."
 
 
 # functions for the bot's logic
 def check_input(grades : list) -> int:
     """Checks if the user's input is a valid score."""
     for desc, grade, credit in grades: # iterates over the user's grades
-        if not (60 <= grade <= 100 and 1 <= credit <= 8): # checks if the grade and credit are in the valid range
+        # checks if the grade and credit are in the valid range
+        if not (MIN_GRADE <= grade <= MAX_GRADE and MIN_CREDIT <= credit <= MAX_CREDIT):
             return 0
         if grade != int(grade) or credit != int(credit): # checks if the grade and credit are integers
             return -1
@@ -148,33 +225,144 @@ def get_grades_input(grades_input : str) -> list:
     return output
 
 
+def get_weighted_totals(grades : list, is_exact : bool) -> tuple:
+    """Returns the total weighted grades and the total weighted credits of a list of grades."""
+    total_weighted = 0
+    total_credits = 0
+    for _, grade, credit, is_advanced in grades:
+        weighted_credit = credit * (ADVANCED_COURSE if is_exact and is_advanced else 1)
+        total_weighted += grade * weighted_credit
+        total_credits += weighted_credit
+
+    return total_weighted, total_credits
+
+
+def get_plan_input(plan_input : str) -> tuple:
+    """Parses the user's planner input into a target average and a list of planned courses (credit, is_advanced)."""
+    lines = [' '.join(line.split()) for line in plan_input.split("\n") if line.strip()]
+    if len(lines) < 2: # a target and at least one planned course are required
+        raise ValueError("Invalid plan format")
+
+    target = float(lines[0])
+    planned = []
+    for line in lines[1:]:
+        after_split = line.split(" ")
+        if len(after_split) > 2 or (len(after_split) == 2 and after_split[1] not in ("מתקדם", "רגיל")):
+            raise ValueError("Invalid plan format")
+        planned.append((float(after_split[0]), after_split[-1] == "מתקדם"))
+
+    return target, planned
+
+
+def check_plan_input(target : float, planned : list) -> bool:
+    """Checks if the target average and the planned courses' credits are in the valid range."""
+    if not MIN_GRADE <= target <= MAX_GRADE:
+        return False
+    return all(MIN_CREDIT <= credit <= MAX_CREDIT and credit == int(credit) for credit, _ in planned)
+
+
+def plan_required_grade(grades : list, planned : list, target : float, is_exact : bool) -> tuple:
+    """
+    Evaluates every possible grade for the planned courses at once over the existing grades
+    and returns the minimum grade that reaches the target and the resulting average.
+    If the target can not be reached, returns None and the best possible average.
+    """
+    # the existing grades are summed only once for all the scenarios
+    total_weighted, total_credits = get_weighted_totals(grades, is_exact)
+    planned_credits = sum(credit * (ADVANCED_COURSE if is_exact and is_advanced else 1)
+                          for credit, is_advanced in planned)
+    all_credits = total_credits + planned_credits
+    averages = [(total_weighted + grade * planned_credits) / all_credits for grade in PLAN_GRADES_RANGE]
+
+    for grade, average in zip(PLAN_GRADES_RANGE, averages):
+        if average >= target:
+            return grade, average
+
+    return None, averages[-1]
+
+
+def build_reply_markups() -> MappingProxyType:
+    """Creates all the inline buttons of the bot, the markups are immutable so all the users share them."""
+    return MappingProxyType({
+        # buttons for the user to choose if he finished entering grades or wants to delete a grade
+        "add_grades": InlineKeyboardMarkup([
+            [InlineKeyboardButton("טען ציונים אחרונים וצרף אותם לקיימים", callback_data="load_last_grades")],
+            [InlineKeyboardButton("טען ציונים שמורים וצרף אותם לקיימים", callback_data="load_saved_grades")],
+            [InlineKeyboardButton("מה אני צריך כדי להגיע לממוצע יעד?", callback_data="plan")],
+            [
+                InlineKeyboardButton("סיימתי", callback_data="finished"),
+                InlineKeyboardButton("מחק ציונים לפי אינדקס", callback_data="delete")
+            ],
+        ]),
+        # buttons for the user to choose if he studies an exact sciences degree
+        "degree_yes_or_no": InlineKeyboardMarkup([[
+            InlineKeyboardButton("כן", callback_data="degree_yes"),
+            InlineKeyboardButton("לא", callback_data="degree_no")
+        ]]),
+        # buttons for the user to load his last grades
+        "load_grades": InlineKeyboardMarkup([
+            [
+                InlineKeyboardButton("טען ציונים אחרונים", callback_data="load_last_grades"),
+                InlineKeyboardButton("טען ציונים שמורים", callback_data="load_saved_grades")
+            ],
+            [InlineKeyboardButton("מה אני צריך כדי להגיע לממוצע יעד?", callback_data="plan")],
+        ]),
+        "change_degree": InlineKeyboardMarkup([[
+            InlineKeyboardButton("החלף סוג תואר", callback_data="change_degree"),
+        ]]),
+        "go_back": InlineKeyboardMarkup([[
+            InlineKeyboardButton("חזור להזנת ציונים", callback_data="go_back"),
+        ]]),
+        "course_type_short": InlineKeyboardMarkup([[
+            InlineKeyboardButton("מתקדם", callback_data="advanced"),
+            InlineKeyboardButton("רגיל", callback_data="regular")
+        ]]),
+        "course_type_long": InlineKeyboardMarkup([[
+            InlineKeyboardButton("מתקדמים", callback_data="advanced"),
+            InlineKeyboardButton("רגילים", callback_data="regular")
+        ]]),
+        "save_grades": InlineKeyboardMarkup([[
+            InlineKeyboardButton("אין צורך", callback_data="dont_save_grades"),
+            InlineKeyboardButton("כן", callback_data="save_grades"),
+        ]]),
+        "exit_feedback": InlineKeyboardMarkup([[
+            InlineKeyboardButton("אני לא מעוניין לכתוב פידבק", callback_data="exit_feedback"),
+        ]]),
+    })
+
+REPLY_MARKUPS = build_reply_markups() # the inline buttons are created once for the whole run
+
 def add_grades_buttons() -> InlineKeyboardMarkup:
-    """Creates inline buttons for the user to choose if he finished entering grades or wants to delete a grade."""
-    keyboard = [
-        [InlineKeyboardButton("טען ציונים אחרונים וצרף אותם לקיימים", callback_data="load_last_grades")],
-        [InlineKeyboardButton("טען ציונים שמורים וצרף אותם לקיימים", callback_data="load_saved_grades")],
-        [
-            InlineKeyboardButton("סיימתי", callback_data="finished"),
-            InlineKeyboardButton("מחק ציונים לפי אינדקס", callback_data="delete")
-        ],
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    """Returns inline buttons for the user to choose if he finished entering grades or wants to delete a grade."""
+    return REPLY_MARKUPS["add_grades"]
 
 def degree_yes_or_no_buttons() -> InlineKeyboardMarkup:
-    """Creates inline buttons for the user to choose if he studies an exact sciences degree."""
-    keyboard = [[
-        InlineKeyboardButton("כן", callback_data="degree_yes"),
-        InlineKeyboardButton("לא", callback_data="degree_no")
-    ]]
-    return InlineKeyboardMarkup(keyboard)
+    """Returns inline buttons for the user to choose if he studies an exact sciences degree."""
+    return REPLY_MARKUPS["degree_yes_or_no"]
 
 def load_grades_buttons() -> InlineKeyboardMarkup:
-    """Creates an inline button for the user to load his last grades."""
-    keyboard = [[
-        InlineKeyboardButton("טען ציונים אחרונים", callback_data="load_last_grades"),
-        InlineKeyboardButton("טען ציונים שמורים", callback_data="load_saved_grades")
-    ]]
-    return InlineKeyboardMarkup(keyboard)
+    """Returns an inline button for the user to load his last grades."""
+    return REPLY_MARKUPS["load_grades"]
+
+@functools.cache
+def get_token() -> str:
+    """Returns the token for the bot, it is read only when the bot starts."""
+    return os.getenv("BOT_TOKEN")
+
+@functools.cache
+def get_admin_id() -> int:
+    """Returns the id of the admin, it is read only when the bot starts."""
+    return int(os.getenv("ADMIN_TELEGRAM_ID"))
+
+@functools.cache
+def get_bot_api_url() -> str:
+    """Returns the url of the bot api server, a self-hosted server can be used instead of telegram's."""
+    return os.getenv("BOT_API_URL", "https://api.telegram.org/bot")
+
+@functools.cache
+def get_workers() -> int:
+    """Returns the number of worker processes of a sharded deployment, 0 runs the bot in a single process."""
+    return int(os.getenv("BOT_WORKERS", "0"))
 
 # serialization and deserialization database functions
 def pack_grades(grades : list) -> str:
@@ -187,9 +375,9 @@ def pack_grades(grades : list) -> str:
 
     return output
 
-def unpack_grades(grades : str) -> list:
-    """Unpacks a string of grades into a list of tuples: (description, grade, credit, is_advanced)."""
-    output = []
+def unpack_grades(grades : str) -> GradeList:
+    """Unpacks a string of grades into a list of grades: (description, grade, credit, is_advanced)."""
+    output = GradeList()
     for line in grades.split("\n"):
         if not line:
             continue
@@ -201,10 +389,183 @@ def unpack_grades(grades : str) -> list:
         else:
             description, grade, credit, is_advance = after_split
 
-        output.append((description, float(grade), float(credit), is_advance == "True"))
+        # older rows store the grade and the credit as floats (e.g. 90.0)
+        output.append((description, int(float(grade)), int(float(credit)), is_advance == "True"))
 
     return output
 
+def get_feedback_query(args: list) -> tuple:
+    """
+    Parses the admin's feedback query into (keyword, start, end, page).
+    Dates are given as YYYY-MM-DD (the first is the start and the second is the inclusive end)
+    and the page is given as #<page>, the rest of the words are the keyword.
+    """
+    words = []
+    dates = []
+    page = 1
+    for arg in args:
+        if arg.startswith("#"):
+            page = int(arg[1:])
+            if page < 1:
+                raise ValueError("Invalid page")
+            continue
+        try:
+            dates.append(datetime.strptime(arg, "%Y-%m-%d"))
+        except ValueError:
+            words.append(arg)
+    if len(dates) > 2:
+        raise ValueError("Too many dates")
+
+    start = int(dates[0].timestamp()) if dates else None
+    end = int((dates[1] + timedelta(days=1)).timestamp()) if len(dates) == 2 else None
+    return " ".join(words), start, end, page
+
+def get_feedbacks_page(feedbacks: list, count: int, page: int) -> str:
+    """Returns a page of feedbacks as a message."""
+    pages = (count + FEEDBACK_PAGE_SIZE - 1) // FEEDBACK_PAGE_SIZE
+    output = FEEDBACKS_HEADER.format(count=count, page=page, pages=pages)
+    for feedback_id, user_id, text, created_at in feedbacks:
+        if len(text) > MAX_FEEDBACK_PREVIEW_LENGTH: # shortens long feedbacks to keep the page in one message
+            text = text[:MAX_FEEDBACK_PREVIEW_LENGTH] + "..."
+        date = datetime.fromtimestamp(created_at).strftime("%Y-%m-%d %H:%M")
+        output += f"#{feedback_id} | {date} | {user_id}\n{text}\n\n"
+
+    return output
+
+async def save_feedbacks(batch: list) -> None:
+    """Writes a batch of feedbacks to the database, again while the database is locked by another process."""
+    from db import insert_feedbacks
+    for attempt in range(1, FEEDBACK_WRITE_ATTEMPTS + 1):
+        try:
+            await insert_feedbacks(batch)
+            return
+        except sqlite3.OperationalError as e:
+            if "locked" in str(e) and attempt < FEEDBACK_WRITE_ATTEMPTS: # another shard is writing
+                await asyncio.sleep(FEEDBACK_RETRY_DELAY)
+                continue
+            error = e
+        except Exception as e:
+            error = e
+        # the feedbacks are still kept in the feedbacks log file
+        feedback_logger.error(f"Unable to save {len(batch)} feedbacks to the database: {error}")
+        return
+
+async def run_feedback_writer() -> None:
+    """Writes the queued feedbacks to the database in batches, off the handlers' path."""
+    batch = [] # the feedbacks taken from the queue that were not written yet
+    try:
+        while True:
+            batch.append(await FEEDBACK_QUEUE.get())
+            await asyncio.sleep(FEEDBACK_FLUSH_INTERVAL) # waits for more feedbacks to write them together
+            while len(batch) < FEEDBACK_BATCH_SIZE and not FEEDBACK_QUEUE.empty():
+                batch.append(FEEDBACK_QUEUE.get_nowait())
+            batch, written_batch = [], batch # a batch that is being written is not written again by the shutdown
+            await save_feedbacks(written_batch)
+    finally: # writes the remaining feedbacks when the bot shuts down
+        while not FEEDBACK_QUEUE.empty():
+            batch.append(FEEDBACK_QUEUE.get_nowait())
+        if batch:
+            await save_feedbacks(batch)
+
+def start_feedback_writer() -> None:
+    """Runs the feedback writer in the background, stop_feedback_writer stops it."""
+    BACKGROUND_TASKS["feedback_writer"] = asyncio.create_task(run_feedback_writer())
+
+async def stop_feedback_writer() -> None:
+    """Stops the feedback writer after it writes the remaining feedbacks."""
+    task = BACKGROUND_TASKS.pop("feedback_writer", None)
+    if task is None:
+        return
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+def get_last_activity() -> float:
+    """Returns the time this process received its last update."""
+    return LAST_ACTIVITY["time"]
+
+async def run_database_maintenance(last_activity) -> None:
+    """
+    Maintains the database periodically: checkpoints the WAL according to its size,
+    vacuums when the bot is idle and takes backups. The blocking work runs on a worker thread.
+    last_activity returns the time the bot received its last update.
+    """
+    from db import get_wal_size, checkpoint_wal, incremental_vacuum, backup_database, get_backups
+    backups = get_backups()
+    last_backup = os.path.getmtime(backups[-1]) if backups else 0
+    while True:
+        await asyncio.sleep(MAINTENANCE_INTERVAL)
+        try:
+            wal_size = get_wal_size()
+            if wal_size >= WAL_TRUNCATE_CHECKPOINT_SIZE:
+                busy, _, _ = await asyncio.to_thread(checkpoint_wal, "TRUNCATE")
+                maintenance_logger.info(f"Truncating checkpoint of a {wal_size} bytes WAL (busy: {busy}).")
+            elif wal_size >= WAL_PASSIVE_CHECKPOINT_SIZE:
+                await asyncio.to_thread(checkpoint_wal, "PASSIVE")
+
+            # vacuums only when no update arrived for a while and no broadcast is in progress
+            if time.time() - last_activity() >= IDLE_TIME and not BROADCAST_TASKS:
+                freed_pages = await asyncio.to_thread(incremental_vacuum, VACUUM_PAGES)
+                if freed_pages:
+                    maintenance_logger.info(f"Vacuum freed {freed_pages} pages.")
+
+            if time.time() - last_backup >= BACKUP_INTERVAL:
+                backup_path = await asyncio.to_thread(backup_database, MAX_BACKUPS)
+                last_backup = time.time()
+                maintenance_logger.info(f"Backed up the database to {backup_path}.")
+        except Exception as e: # the next run tries again
+            maintenance_logger.error(f"Database maintenance failed: {e}")
+
+def start_database_maintenance(last_activity) -> None:
+    """Runs the database maintenance in the background, stop_database_maintenance stops it."""
+    BACKGROUND_TASKS["database_maintenance"] = asyncio.create_task(run_database_maintenance(last_activity))
+
+async def stop_database_maintenance() -> None:
+    """Stops the database maintenance."""
+    task = BACKGROUND_TASKS.pop("database_maintenance", None)
+    if task is None:
+        return
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+def get_update_cost(text: str) -> int:
+    """
+    Returns the number of tokens an update costs, long pastes cost more.
+    The cost is at most a full bucket, so every update can be admitted after the user waits.
+    """
+    if not text:
+        return 1
+    return min(1 + text.count("\n") // LINES_PER_TOKEN, RATE_LIMIT_BURST)
+
+def admit_update(user_id: int, cost: int, now: float) -> bool:
+    """Takes the update's cost from the user's token bucket, returns False if the user has to slow down."""
+    if user_id not in RATE_LIMIT_BUCKETS and len(RATE_LIMIT_BUCKETS) >= MAX_RATE_LIMITED_USERS:
+        # removes the users whose bucket has been refilled completely, they are the same as new users
+        idle_time = RATE_LIMIT_BURST / RATE_LIMIT_PER_SECOND
+        for idle_user_id in [uid for uid, (_, last, _) in RATE_LIMIT_BUCKETS.items() if now - last >= idle_time]:
+            del RATE_LIMIT_BUCKETS[idle_user_id]
+
+    tokens, last, last_reply = RATE_LIMIT_BUCKETS.get(user_id, (RATE_LIMIT_BURST, now, 0))
+    tokens = min(RATE_LIMIT_BURST, tokens + (now - last) * RATE_LIMIT_PER_SECOND) # refills the bucket
+    if tokens < cost:
+        RATE_LIMIT_BUCKETS[user_id] = (tokens, now, last_reply)
+        return False
+    RATE_LIMIT_BUCKETS[user_id] = (tokens - cost, now, last_reply)
+    return True
+
+def should_reply_slow_down(user_id: int, now: float) -> bool:
+    """Checks if a shed user should be told to slow down, so a flood does not cost a reply per update."""
+    tokens, last, last_reply = RATE_LIMIT_BUCKETS.get(user_id, (RATE_LIMIT_BURST, now, 0))
+    if now - last_reply < SLOW_DOWN_REPLY_INTERVAL:
+        return False
+    RATE_LIMIT_BUCKETS[user_id] = (tokens, last, now)
+    return True
+
 def log_user(user_id: int, message: str) -> None:
     """Logs the user id and message to the user log file."""
     user_logger.info(f"User {user_id} {message}.")
@@ -213,49 +574,144 @@ def log_user_and_active_users(user_id: int, message: str) -> None:
     """Logs the user id, message and the total active users to the user log file."""
     user_logger.info(f"User {user_id} {message}. Total active users: {len(ACTIVE_USERS)}")
 
-async def send_broadcast_message(text: str) -> int:
-    """Sends a message to all users."""
-    from db import get_all_users_ids
-    bot = Bot(token=TOKEN)
-    user_ids = await get_all_users_ids() # retrieves all user ids from the database
-    successfully_sent = 0 # counter for the successfully sent messages
-    for user_id in user_ids:
+def is_unreachable_error(error: Exception) -> bool:
+    """Checks if a delivery error means that the user can not receive messages anymore."""
+    if isinstance(error, Forbidden): # the user blocked the bot or deleted his account
+        return True
+    return isinstance(error, BadRequest) and "chat not found" in str(error).lower()
+
+def get_retry_after_seconds(error: RetryAfter) -> float:
+    """Returns the number of seconds telegram asked to wait before sending again."""
+    if isinstance(error.retry_after, timedelta):
+        return error.retry_after.total_seconds()
+    return error.retry_after
+
+def get_broadcast_job_text(job : tuple) -> str:
+    """Returns the progress text of a broadcast job according to its status."""
+    job_id, _, status, _, _, total, sent, failed, skipped = job
+    if status == "done":
+        msg = BROADCAST_JOB_DONE
+    elif status == "cancelled":
+        msg = BROADCAST_JOB_CANCELLED
+    else:
+        msg = BROADCAST_JOB_PROGRESS
+    return msg.format(job_id=job_id, sent=sent, total=total, failed=failed, skipped=skipped)
+
+async def report_broadcast_progress(bot: Bot, job_id: int) -> None:
+    """Edits the admin's progress message of a broadcast job."""
+    from db import get_broadcast_job
+    job = await get_broadcast_job(job_id)
+    _, _, _, admin_chat_id, progress_message_id, _, _, _, _ = job
+    if progress_message_id is None: # if the progress message was not sent yet
+        return
+    try:
+        await bot.edit_message_text(get_broadcast_job_text(job), chat_id=admin_chat_id, message_id=progress_message_id)
+    except Exception as e: # the progress message is only informative, the job goes on
+        log_user(admin_chat_id, f"was unable to receive the progress of broadcast job {job_id}: {e}")
+
+async def run_broadcast_job(bot: Bot, job_id: int) -> None:
+    """Sends a broadcast job to its pending recipients and saves a checkpoint after every batch."""
+    from db import (get_broadcast_job, get_pending_broadcast_recipients,
+                    checkpoint_broadcast_recipients, update_broadcast_job_status)
+    try:
+        while True:
+            _, text, status, _, _, _, _, _, _ = await get_broadcast_job(job_id)
+            if status != "running": # if the admin cancelled the job
+                break
+            user_ids = await get_pending_broadcast_recipients(job_id, BROADCAST_BATCH_SIZE)
+            if not user_ids: # if all the recipients were handled
+                await update_broadcast_job_status(job_id, "done")
+                break
+            results = [] # the delivery results of the batch
+            try:
+                for user_id in user_ids:
+                    while True:
+                        try:
+                            await bot.send_message(chat_id=user_id, text=text)
+                            results.append((user_id, True, False))
+                        except RetryAfter as e: # waits as long as telegram asks and sends to the same user again
+                            await asyncio.sleep(get_retry_after_seconds(e))
+                            continue
+                        except TelegramError as e: # only telegram's errors are failures of the delivery to the user
+                            log_user(user_id, f"was unable to receive a message: {e}")
+                            results.append((user_id, False, is_unreachable_error(e)))
+                        break
+                    await asyncio.sleep(SLEEP_TIME) # sleep between the messages to avoid flooding the server
+            except asyncio.CancelledError: # saves the part of the batch that was sent, the job resumes after it
+                if results:
+                    await checkpoint_broadcast_recipients(job_id, results)
+                raise
+            except Exception as e: # the rest of the batch stays pending, the job resumes after the part that was sent
+                log_user(get_admin_id(), f"had broadcast job {job_id} interrupted until the next start: {e}")
+                if results:
+                    await checkpoint_broadcast_recipients(job_id, results)
+                return
+            await checkpoint_broadcast_recipients(job_id, results)
+            await report_broadcast_progress(bot, job_id)
+        await report_broadcast_progress(bot, job_id)
+    finally:
+        BROADCAST_TASKS.pop(job_id, None)
+
+def start_broadcast_job(application, job_id: int) -> None:
+    """
+    Runs a broadcast job in the background unless it is already running.
+    The task is not tracked by the application, so stopping the bot does not wait for the whole broadcast.
+    """
+    if job_id in BROADCAST_TASKS:
+        return
+    BROADCAST_TASKS[job_id] = asyncio.create_task(run_broadcast_job(application.bot, job_id))
+
+async def stop_broadcast_jobs() -> None:
+    """Stops the running broadcast jobs, they resume from their last checkpoint when the bot starts again."""
+    tasks = list(BROADCAST_TASKS.values())
+    for task in tasks:
+        task.cancel()
+    for task in tasks:
         try:
-            await bot.send_message(chat_id=user_id, text=text)
-            successfully_sent += 1
-        except Exception as e:
-            log_user(user_id, f"was unable to receive a message: {e}")
-        await asyncio.sleep(SLEEP_TIME) # sleep for a second to avoid flooding the server
-
-    return successfully_sent # returns the number of successfully sent messages
-
-async def send_single_message(user_id: int, text: str) -> None:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+async def resume_broadcast_jobs(application) -> None:
+    """Resumes the broadcast jobs that were interrupted by a restart from their last checkpoint."""
+    from db import get_running_broadcast_jobs_ids
+    for job_id in await get_running_broadcast_jobs_ids():
+        log_user(get_admin_id(), f"broadcast job {job_id} is resumed")
+        start_broadcast_job(application, job_id)
+
+async def send_single_message(bot: Bot, user_id: int, text: str) -> None:
     """Sends a message to specific user."""
-    bot = Bot(token=TOKEN)
+    from db import record_delivery_results
     try:
         await bot.send_message(chat_id=user_id, text=text)
-    except Exception as e:
+        await record_delivery_results([(user_id, True, False)])
+    except TelegramError as e:
         log_user(user_id, f"was unable to receive a message: {e}")
-
-
-# define the logging configuration
-logging.basicConfig(
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    level=logging.INFO
-)
-
-# logs for the users
-user_logger = logging.getLogger("user_logger")
-user_handler = logging.FileHandler("bot_users.log")
-user_formatter = logging.Formatter("%(asctime)s - %(message)s")
-user_handler.setFormatter(user_formatter)
-user_logger.addHandler(user_handler)
-user_logger.setLevel(logging.INFO)
-
-# logs for the feedbacks sent by the users
-feedback_logger = logging.getLogger("feedback_logger")
-feedback_handler = logging.FileHandler("feedbacks.log", encoding="utf-8")
-feedback_formatter = logging.Formatter("%(asctime)s - %(message)s")
-feedback_handler.setFormatter(feedback_formatter)
-feedback_logger.addHandler(feedback_handler)
-feedback_logger.setLevel(logging.INFO)
\ No newline at end of file
+        await record_delivery_results([(user_id, False, is_unreachable_error(e))])
+
+
+# loggers of the bot, their files are opened by setup_logging when the bot starts
+user_logger = logging.getLogger("user_logger") # logs for the users
+feedback_logger = logging.getLogger("feedback_logger") # logs for the feedbacks sent by the users
+maintenance_logger = logging.getLogger("maintenance_logger") # logs for the database maintenance
+
+def setup_logging() -> None:
+    """Defines the logging configuration and opens the log files."""
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        level=logging.INFO
+    )
+
+    user_handler = logging.FileHandler("bot_users.log")
+    user_formatter = logging.Formatter("%(asctime)s - %(message)s")
+    user_handler.setFormatter(user_formatter)
+    user_logger.addHandler(user_handler)
+    user_logger.setLevel(logging.INFO)
+
+    feedback_handler = logging.FileHandler("feedbacks.log", encoding="utf-8")
+    feedback_formatter = logging.Formatter("%(asctime)s - %(message)s")
+    feedback_handler.setFormatter(feedback_formatter)
+    feedback_logger.addHandler(feedback_handler)
+    feedback_logger.setLevel(logging.INFO)
+
+    maintenance_logger.setLevel(logging.INFO)